@@ -1,14 +1,15 @@
 from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 import uvicorn
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import text
+import asyncpg
+import orjson
 from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Optional
+from datetime import date
 import os
-
-# 設定 FastAPI 應用程式
-app = FastAPI()
+import re
 
 # 資料庫連線設定 
 host = os.getenv("DB_HOST", "127.0.0.1")
@@ -16,8 +17,414 @@ database = "postgres"
 user = "postgres"
 password = "admin"
 port = "5432"
-engine = create_async_engine(f"postgresql+asyncpg://{user}:{password}@{host}:{port}/{database}", echo=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
+
+# asyncpg連線池 於每個worker啟動時建立
+pool = None
+
+
+# 建立與關閉資料庫連線池
+# 連線會快取已準備的查詢語句(server-side prepared statement) 同一連線的後續請求直接重複使用
+@asynccontextmanager
+async def lifespan(app):
+    global pool
+    pool = await asyncpg.create_pool(
+        f"postgresql://{user}:{password}@{host}:{port}/{database}",
+        min_size=2,
+        max_size=10,
+        max_cached_statement_lifetime=0,  # 已準備的查詢語句不會因閒置而失效
+    )
+    yield
+    await pool.close()
+
+
+# 設定 FastAPI 應用程式
+app = FastAPI(lifespan=lifespan)
+
+
+# 以orjson編碼回傳JSON結果 不經回傳模型驗證
+def json_response(payload):
+    return Response(orjson.dumps(payload), media_type="application/json")
+
+
+# 將具名參數(:name)的查詢語句轉為asyncpg的位置參數($1) 回傳查詢語句與參數名稱順序
+def prepare_query(sql):
+    params = []
+
+    def replace(match):
+        if match.group(1) not in params:
+            params.append(match.group(1))
+        return f"${params.index(match.group(1)) + 1}"
+
+    return re.sub(r"(?<!:):(\w+)", replace, sql), params
+
+
+# 執行查詢並回傳第一筆資料 參數值依名稱自請求模型取出
+async def fetch_row(query, request):
+    sql, params = query
+    async with pool.acquire() as conn:
+        return await conn.fetchrow(sql, *[getattr(request, param) for param in params])
+
+
+# 圓形範圍的頂點數 與PostGIS ST_Buffer預設(每1/4圓8段)相同
+BUFFER_SEGMENTS = 32
+
+
+# WGS84橢球 面積於程式內以測地線計算 與PostGIS geography型別結果一致
+# pyproj等套件於第一次使用時才載入 縮短worker啟動時間
+@lru_cache(maxsize=None)
+def get_geod():
+    from pyproj import Geod
+    return Geod(ellps="WGS84")
+
+
+# 計算WKT格式幾何範圍的測地線面積(平方公尺)
+def geodesic_area(wkt_polygon):
+    from shapely import wkt
+    from shapely.geometry.polygon import orient
+
+    geometry = wkt.loads(wkt_polygon)
+    polygons = getattr(geometry, "geoms", [geometry])
+    # 統一外圍邊界為逆時針、內部孔洞為順時針 孔洞面積才會被正確扣除
+    return abs(sum(get_geod().geometry_area_perimeter(orient(polygon))[0] for polygon in polygons))
+
+
+# 計算單點半徑範圍(測地線圓)的面積(平方公尺)
+def geodesic_buffer_area(longitude, latitude, radius):
+    import numpy as np
+
+    geod = get_geod()
+    azimuths = np.linspace(0, 360, BUFFER_SEGMENTS, endpoint=False)
+    lons, lats, _ = geod.fwd(
+        np.full(BUFFER_SEGMENTS, longitude),
+        np.full(BUFFER_SEGMENTS, latitude),
+        azimuths,
+        np.full(BUFFER_SEGMENTS, radius),
+    )
+    area, _ = geod.polygon_area_perimeter(lons, lats)
+    return abs(area)
+
+
+# 密度網格檔案位置(由data_to_postgis.py產生)
+GRID_PATH = os.getenv("GRID_PATH", "grid")
+
+# 密度網格圖層 對應網格檔案的第幾層
+DENSITY_LAYERS = {"households": 0, "population": 1}
+
+# 熱度圖圖磚大小(像素)
+TILE_SIZE = 256
+
+
+# 密度網格檔案 中繼資料由匯入程式最後寫入
+DENSITY_GRID_FILES = ("density_grid.json", "density_grid.npy", "density_sat.npy")
+
+# 目前已載入的密度網格(版本、中繼資料、網格與累加面積表)
+# 以單一tuple一次指定 多執行緒同時讀取時版本與資料不會錯置
+loaded_density_grid = None
+
+
+# 以檔案修改時間作為密度網格版本 匯入程式重新產生網格後會自動重新載入
+def get_density_grid_version():
+    return tuple(os.stat(os.path.join(GRID_PATH, name)).st_mtime_ns for name in DENSITY_GRID_FILES)
+
+
+# 以記憶體映射方式讀取密度網格與累加面積表 多個worker共用同一份檔案快取
+# 回傳網格版本、中繼資料、網格與累加面積表
+def get_density_grid():
+    global loaded_density_grid
+    import json
+    import numpy as np
+
+    loaded = loaded_density_grid
+    version = get_density_grid_version()
+    if loaded is not None and loaded[0] == version:
+        return loaded
+
+    # 中繼資料早於陣列檔表示匯入程式正在更新檔案 先沿用前一版網格
+    if version[0] < max(version[1:]) and loaded is not None:
+        return loaded
+
+    with open(os.path.join(GRID_PATH, "density_grid.json")) as f:
+        meta = json.load(f)
+    grid = np.load(os.path.join(GRID_PATH, "density_grid.npy"), mmap_mode="r")
+    sat = np.load(os.path.join(GRID_PATH, "density_sat.npy"), mmap_mode="r")
+    if grid.shape[1:] != (meta["rows"], meta["cols"]) or sat.shape[1:] != (meta["rows"] + 1, meta["cols"] + 1):
+        raise RuntimeError("Density grid files are being updated")
+
+    loaded_density_grid = (version, meta, grid, sat)
+    return loaded_density_grid
+
+
+# WGS84經緯度轉換為密度網格座標系(公尺)的轉換器
+@lru_cache(maxsize=None)
+def get_grid_transformer(crs):
+    from pyproj import Transformer
+
+    return Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+
+
+# 以密度網格估算多邊形範圍內的家戶數與人口數
+# 逐列取多邊形與網格中心線的交集區段 每個區段為一個網格矩形 以累加面積表O(1)求和
+def density_estimate(wkt_polygon):
+    import numpy as np
+    import shapely
+    from shapely import wkt
+
+    _, meta, _, sat = get_density_grid()
+    x0, y0, cell_size = meta["x0"], meta["y0"], meta["cell_size"]
+    transformer = get_grid_transformer(meta["crs"])
+
+    # 使用者可能繪製自我相交的多邊形 先修正為有效幾何 避免交集運算失敗
+    polygon = shapely.make_valid(shapely.transform(
+        wkt.loads(wkt_polygon),
+        lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1])),
+    ))
+    min_x, min_y, max_x, max_y = polygon.bounds
+
+    # 網格中心線落在多邊形範圍內的列
+    first_row = max(int(np.ceil((min_y - y0) / cell_size - 0.5)), 0)
+    last_row = min(int(np.floor((max_y - y0) / cell_size - 0.5)), meta["rows"] - 1)
+    if first_row > last_row:
+        return {"households": 0.0, "population": 0.0}
+
+    rows = np.arange(first_row, last_row + 1)
+    center_y = y0 + (rows + 0.5) * cell_size
+    lines = shapely.linestrings(np.stack([
+        np.column_stack([np.full(len(rows), min_x - cell_size), center_y]),
+        np.column_stack([np.full(len(rows), max_x + cell_size), center_y]),
+    ], axis=1))
+    segments, index = shapely.get_parts(shapely.intersection(lines, polygon), return_index=True)
+    segments_bounds = shapely.bounds(segments)
+    valid = ~np.isnan(segments_bounds[:, 0])
+
+    # 網格中心點落在區段內的欄
+    segment_rows = rows[index[valid]]
+    first_cols = np.maximum(np.ceil((segments_bounds[valid, 0] - x0) / cell_size - 0.5).astype(int), 0)
+    last_cols = np.minimum(np.floor((segments_bounds[valid, 2] - x0) / cell_size - 0.5).astype(int), meta["cols"] - 1)
+    keep = first_cols <= last_cols
+    segment_rows, first_cols, last_cols = segment_rows[keep], first_cols[keep], last_cols[keep]
+
+    totals = (
+        sat[:, segment_rows + 1, last_cols + 1]
+        - sat[:, segment_rows, last_cols + 1]
+        - sat[:, segment_rows + 1, first_cols]
+        + sat[:, segment_rows, first_cols]
+    ).sum(axis=1)
+    return {"households": float(totals[0]), "population": float(totals[1])}
+
+
+# 將RGBA陣列編碼為PNG圖檔
+def encode_png(rgba):
+    import struct
+    import zlib
+    import numpy as np
+
+    height, width, _ = rgba.shape
+    # 每列前加上濾波類型(0: 不濾波)
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, -1)], axis=1).tobytes()
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw))
+        + chunk(b"IEND", b"")
+    )
+
+
+# 繪製密度網格熱度圖圖磚(Web Mercator XYZ圖磚)
+# 圖磚快取以網格版本區分 網格更新後即重新繪製
+def render_density_tile(layer, z, x, y):
+    version, _, _, _ = get_density_grid()
+    return render_density_tile_version(version, layer, z, x, y)
+
+
+# 依圖磚每個像素中心所在的網格取值 以對數比例由黃至紅著色 無資料處透明
+@lru_cache(maxsize=2048)
+def render_density_tile_version(version, layer, z, x, y):
+    import numpy as np
+
+    current_version, meta, grid, _ = get_density_grid()
+    if current_version != version:
+        raise RuntimeError("Density grid files are being updated")
+    values = grid[DENSITY_LAYERS[layer]]
+    max_value = meta[f"max_{layer}"]
+
+    # 像素中心的經緯度
+    n = 2 ** z
+    pixels = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    longitudes = (x + pixels) / n * 360 - 180
+    latitudes = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + pixels) / n))))
+    longitudes, latitudes = np.meshgrid(longitudes, latitudes)
+
+    # 像素所在的網格
+    grid_x, grid_y = get_grid_transformer(meta["crs"]).transform(longitudes, latitudes)
+    cols = np.floor((grid_x - meta["x0"]) / meta["cell_size"]).astype(int)
+    rows = np.floor((grid_y - meta["y0"]) / meta["cell_size"]).astype(int)
+    inside = (cols >= 0) & (cols < meta["cols"]) & (rows >= 0) & (rows < meta["rows"])
+
+    density = np.zeros((TILE_SIZE, TILE_SIZE))
+    density[inside] = values[rows[inside], cols[inside]]
+    ratio = np.log1p(density) / np.log1p(max_value) if max_value > 0 else density
+
+    rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    rgba[..., 0] = 255
+    rgba[..., 1] = (255 * (1 - ratio)).astype(np.uint8)
+    rgba[..., 3] = np.where(density > 0, 80 + 150 * ratio, 0).astype(np.uint8)
+    return encode_png(rgba)
+
+
+# 取得指定日期(含)以前最新一期快照的子查詢 未指定日期時為最新快照
+# 以子查詢寫在WHERE條件中 PostgreSQL執行時即可只掃描對應的分區
+def snapshot_sql(table_name, param):
+    return f"""(
+        SELECT max(snapshot_date) FROM snapshots
+        WHERE table_name = '{table_name}'
+        AND snapshot_date <= COALESCE(CAST(:{param} AS date), 'infinity'::date)
+    )"""
+
+
+# 取得比較快照的子查詢 未指定比較日期時為NULL
+def compare_snapshot_sql(table_name):
+    return f"""(
+        SELECT max(snapshot_date) FROM snapshots
+        WHERE table_name = '{table_name}'
+        AND CAST(:compare_snapshot AS date) IS NOT NULL
+        AND snapshot_date <= CAST(:compare_snapshot AS date)
+    )"""
+
+
+# 查詢語句於載入模組時轉換一次 所有請求共用
+# 單點半徑範圍內家戶數
+HOUSEHOLDS_POINT_QUERY = prepare_query(f"""
+    SELECT
+        count(*) FILTER (WHERE snapshot_date = {snapshot_sql('households', 'snapshot')}) as households,
+        count(*) FILTER (WHERE snapshot_date = {compare_snapshot_sql('households')}) as compare_households,
+        {snapshot_sql('households', 'snapshot')} AS snapshot_date,
+        {compare_snapshot_sql('households')} AS compare_snapshot_date
+    FROM households
+    WHERE snapshot_date IN ({snapshot_sql('households', 'snapshot')}, {compare_snapshot_sql('households')})
+    AND ST_DWithin(
+        geography(ST_SetSRID(ST_Point(:longitude, :latitude), 4326)),
+        geography(geometry),
+        :radius
+    );
+""")
+
+
+# 單點半徑範圍內人口數
+POPULATION_POINT_QUERY = prepare_query(f"""
+    WITH 
+    target_point AS (
+        SELECT ST_SetSRID(ST_MakePoint(:longitude, :latitude), 4326) AS geom
+    ),
+    buffered_area AS (
+        SELECT ST_Buffer(ST_Transform(geom, 3857), :radius) AS geom
+        FROM target_point
+    )
+    SELECT
+        sum(population.p_cnt) FILTER (WHERE population.snapshot_date = {snapshot_sql('population', 'snapshot')}) as population,
+        sum(population.p_cnt) FILTER (WHERE population.snapshot_date = {compare_snapshot_sql('population')}) as compare_population,
+        {snapshot_sql('population', 'snapshot')} AS snapshot_date,
+        {compare_snapshot_sql('population')} AS compare_snapshot_date
+    FROM population
+    JOIN buffered_area ON ST_Intersects(ST_Transform(population.geometry, 3857), buffered_area.geom)
+    WHERE population.snapshot_date IN ({snapshot_sql('population', 'snapshot')}, {compare_snapshot_sql('population')})
+    AND (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), buffered_area.geom)) / ST_Area(ST_Transform(population.geometry, 3857))) >= :overlap_ratio;
+""")
+
+
+# 多邊形範圍內家戶數
+HOUSEHOLDS_POLYGON_QUERY = prepare_query(f"""
+    SELECT
+        count(*) FILTER (WHERE snapshot_date = {snapshot_sql('households', 'snapshot')}) as households,
+        count(*) FILTER (WHERE snapshot_date = {compare_snapshot_sql('households')}) as compare_households,
+        {snapshot_sql('households', 'snapshot')} AS snapshot_date,
+        {compare_snapshot_sql('households')} AS compare_snapshot_date
+    FROM households
+    WHERE snapshot_date IN ({snapshot_sql('households', 'snapshot')}, {compare_snapshot_sql('households')})
+    AND ST_Within(
+        geometry, 
+        ST_GeomFromText(:wkt_polygon, 4326));
+""")
+
+
+# 多邊形範圍內人口數
+POPULATION_POLYGON_QUERY = prepare_query(f"""
+    WITH 
+    input_polygon AS (
+        SELECT ST_SetSRID(ST_GeomFromText(:wkt_polygon), 4326) AS geom
+    )
+    SELECT
+        sum(population.p_cnt) FILTER (WHERE population.snapshot_date = {snapshot_sql('population', 'snapshot')}) as population,
+        sum(population.p_cnt) FILTER (WHERE population.snapshot_date = {compare_snapshot_sql('population')}) as compare_population,
+        {snapshot_sql('population', 'snapshot')} AS snapshot_date,
+        {compare_snapshot_sql('population')} AS compare_snapshot_date
+    FROM population
+    JOIN input_polygon ON ST_Intersects(ST_Transform(population.geometry, 3857), ST_Transform(input_polygon.geom, 3857))
+    WHERE population.snapshot_date IN ({snapshot_sql('population', 'snapshot')}, {compare_snapshot_sql('population')})
+    AND (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), ST_Transform(input_polygon.geom, 3857))) / ST_Area(ST_Transform(population.geometry, 3857))) >= :overlap_ratio;
+""")
+
+
+# 多邊形變更前後的家戶數變化量
+HOUSEHOLDS_POLYGON_DELTA_QUERY = prepare_query(f"""
+    WITH
+    previous_polygon AS (
+        SELECT ST_GeomFromText(:previous_wkt_polygon, 4326) AS geom
+    ),
+    input_polygon AS (
+        SELECT ST_GeomFromText(:wkt_polygon, 4326) AS geom
+    ),
+    changed_area AS (
+        SELECT ST_SymDifference(previous_polygon.geom, input_polygon.geom) AS geom
+        FROM previous_polygon, input_polygon
+    )
+    SELECT
+        count(*) FILTER (WHERE ST_Within(households.geometry, input_polygon.geom))
+        - count(*) FILTER (WHERE ST_Within(households.geometry, previous_polygon.geom)) AS households_delta,
+        {snapshot_sql('households', 'snapshot')} AS snapshot_date
+    FROM households, previous_polygon, input_polygon, changed_area
+    WHERE households.snapshot_date = {snapshot_sql('households', 'snapshot')}
+    AND ST_Intersects(households.geometry, changed_area.geom);
+""")
+
+
+# 多邊形變更前後的人口數變化量
+POPULATION_POLYGON_DELTA_QUERY = prepare_query(f"""
+    WITH
+    previous_polygon AS (
+        SELECT ST_Transform(ST_GeomFromText(:previous_wkt_polygon, 4326), 3857) AS geom
+    ),
+    input_polygon AS (
+        SELECT ST_Transform(ST_GeomFromText(:wkt_polygon, 4326), 3857) AS geom
+    ),
+    changed_area AS (
+        SELECT ST_SymDifference(
+            ST_GeomFromText(:previous_wkt_polygon, 4326),
+            ST_GeomFromText(:wkt_polygon, 4326)
+        ) AS geom
+    ),
+    changed_population AS (
+        SELECT population.p_cnt, ST_Transform(population.geometry, 3857) AS geom
+        FROM population, changed_area
+        WHERE population.snapshot_date = {snapshot_sql('population', 'snapshot')}
+        AND ST_Intersects(population.geometry, changed_area.geom)
+    )
+    SELECT
+        COALESCE(sum(changed_population.p_cnt) FILTER (
+            WHERE ST_Intersects(changed_population.geom, input_polygon.geom)
+            AND (ST_Area(ST_Intersection(changed_population.geom, input_polygon.geom)) / ST_Area(changed_population.geom)) >= :overlap_ratio
+        ), 0)
+        - COALESCE(sum(changed_population.p_cnt) FILTER (
+            WHERE ST_Intersects(changed_population.geom, previous_polygon.geom)
+            AND (ST_Area(ST_Intersection(changed_population.geom, previous_polygon.geom)) / ST_Area(changed_population.geom)) >= :overlap_ratio
+        ), 0) AS population_delta,
+        {snapshot_sql('population', 'snapshot')} AS snapshot_date
+    FROM changed_population, previous_polygon, input_polygon;
+""")
+
 
 # 請求單點模型
 class PointRequest(BaseModel):
@@ -25,6 +432,8 @@ class PointRequest(BaseModel):
     latitude: float  # 緯度
     radius: float  # 單位為公尺
     overlap_ratio: float = Query(0.8, ge=0, le=1)  # 重疊面積比率門檻 超過此門檻才會被納入計算 預設為80%
+    snapshot: Optional[date] = None  # 資料快照日期 使用該日期(含)以前最新一期資料 預設為最新資料
+    compare_snapshot: Optional[date] = None  # 比較快照日期 有指定時一併回傳兩期差異
 
     model_config = {
         "json_schema_extra": {
@@ -43,6 +452,8 @@ class PointRequest(BaseModel):
 class PolygonRequest(BaseModel):
     wkt_polygon: str  # Well-Known Text 格式的多邊形 例如: POLYGON((x1 y1, x2 y2, x3 y3, x1 y1))
     overlap_ratio: float = Query(0.8, ge=0, le=1)  # 重疊面積比率門檻 超過此門檻才會被納入計算 預設為80%
+    snapshot: Optional[date] = None  # 資料快照日期 使用該日期(含)以前最新一期資料 預設為最新資料
+    compare_snapshot: Optional[date] = None  # 比較快照日期 有指定時一併回傳兩期差異
 
     model_config = {
         "json_schema_extra": {
@@ -55,18 +466,147 @@ class PolygonRequest(BaseModel):
         }
     }
 
+# 請求多邊範圍變更模型(編輯多邊形時只計算前後範圍的差異)
+class PolygonDeltaRequest(BaseModel):
+    previous_wkt_polygon: str  # 變更前的多邊形(Well-Known Text 格式)
+    wkt_polygon: str  # 變更後的多邊形(Well-Known Text 格式)
+    overlap_ratio: float = Query(0.8, ge=0, le=1)  # 重疊面積比率門檻 超過此門檻才會被納入計算 預設為80%
+    snapshot: Optional[date] = None  # 資料快照日期 使用該日期(含)以前最新一期資料 預設為最新資料
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "previous_wkt_polygon": "POLYGON((120.1828 22.9961, 120.1811 22.9869, 120.1906 22.9926, 120.1828 22.9961))",
+                    "wkt_polygon": "POLYGON((120.1828 22.9961, 120.1811 22.9869, 120.1950 22.9926, 120.1828 22.9961))",
+                    "overlap_ratio": 0.8
+                }
+            ]
+        }
+    }
+
+# 請求單點半徑範圍面積模型(面積於程式內計算 與資料快照無關)
+class AreaPointRequest(BaseModel):
+    longitude: float  # 經度
+    latitude: float  # 緯度
+    radius: float  # 單位為公尺
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "longitude": 120.1854,
+                    "latitude": 22.9921,
+                    "radius": 500
+                }
+            ]
+        }
+    }
+
+# 請求多邊範圍面積模型(面積於程式內計算 與資料快照無關)
+class AreaPolygonRequest(BaseModel):
+    wkt_polygon: str  # Well-Known Text 格式的多邊形 例如: POLYGON((x1 y1, x2 y2, x3 y3, x1 y1))
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "wkt_polygon": "POLYGON((120.1828 22.9961, 120.1811 22.9869, 120.1906 22.9926, 120.1828 22.9961))"
+                }
+            ]
+        }
+    }
+
+# 請求密度網格估算模型(網格依最近一次匯入的資料建立 不區分快照)
+class DensityEstimateRequest(BaseModel):
+    wkt_polygon: str  # Well-Known Text 格式的多邊形 例如: POLYGON((x1 y1, x2 y2, x3 y3, x1 y1))
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "wkt_polygon": "POLYGON((120.1828 22.9961, 120.1811 22.9869, 120.1906 22.9926, 120.1828 22.9961))"
+                }
+            ]
+        }
+    }
+
 # 回傳家戶數模型
 class HouseholdsResponse(BaseModel):
     households: int  # 家戶數量
+    compare_households: Optional[int] = None  # 比較快照的家戶數量
+    households_diff: Optional[int] = None  # 家戶數量差異(households - compare_households)
+    snapshot: date  # 實際使用的資料快照日期
+    compare_snapshot: Optional[date] = None  # 實際使用的比較快照日期
 
 # 回傳人口數模型
 class PopulationResponse(BaseModel):
     population: int  # 人口數量
+    compare_population: Optional[int] = None  # 比較快照的人口數量
+    population_diff: Optional[int] = None  # 人口數量差異(population - compare_population)
+    snapshot: date  # 實際使用的資料快照日期
+    compare_snapshot: Optional[date] = None  # 實際使用的比較快照日期
+
+# 回傳家戶數變化量模型
+class HouseholdsDeltaResponse(BaseModel):
+    households_delta: int  # 變更後減去變更前的家戶數量
+    snapshot: date  # 實際使用的資料快照日期
+
+# 回傳人口數變化量模型
+class PopulationDeltaResponse(BaseModel):
+    population_delta: int  # 變更後減去變更前的人口數量
+    snapshot: date  # 實際使用的資料快照日期
 
 # 回傳面積模型
 class AreaResponse(BaseModel):
     area: float  # 面積(平方米)
 
+# 回傳密度網格估算模型
+class DensityEstimateResponse(BaseModel):
+    households: float  # 估算家戶數量
+    population: float  # 估算人口數量
+
+# 檢查請求的快照日期是否有對應的資料快照 沒有時回傳404 避免把查無快照當成0筆資料
+def check_snapshots(data, request):
+    if data["snapshot_date"] is None:
+        raise HTTPException(status_code=404, detail="No snapshot found on or before the specified snapshot date")
+    if getattr(request, "compare_snapshot", None) is not None and data["compare_snapshot_date"] is None:
+        raise HTTPException(status_code=404, detail="No snapshot found on or before the specified compare snapshot date")
+
+
+# 整理家戶數回傳結果 有指定比較快照時一併回傳差異
+def households_response(data, request):
+    check_snapshots(data, request)
+    households = data["households"] or 0
+    if request.compare_snapshot is None:
+        return {"households": households, "snapshot": data["snapshot_date"]}
+    compare_households = data["compare_households"] or 0
+    return {
+        "households": households,
+        "compare_households": compare_households,
+        "households_diff": households - compare_households,
+        "snapshot": data["snapshot_date"],
+        "compare_snapshot": data["compare_snapshot_date"],
+    }
+
+
+# 整理人口數回傳結果 有指定比較快照時一併回傳差異
+def population_response(data, request):
+    check_snapshots(data, request)
+    # sum()結果為numeric型別 轉為整數後才能以orjson編碼
+    population = int(data["population"] or 0)
+    if request.compare_snapshot is None:
+        return {"population": population, "snapshot": data["snapshot_date"]}
+    compare_population = int(data["compare_population"] or 0)
+    return {
+        "population": population,
+        "compare_population": compare_population,
+        "population_diff": population - compare_population,
+        "snapshot": data["snapshot_date"],
+        "compare_snapshot": data["compare_snapshot_date"],
+    }
+
+
 # 首頁
 @app.get("/", response_class=HTMLResponse)
 async def index():
@@ -78,184 +618,175 @@ async def index():
 # 計算單點半徑範圍內家戶數
 @app.post("/households/point", response_model=HouseholdsResponse)
 async def get_households_within_radius(request: PointRequest):
-    async with SessionLocal() as session:
-        try:
-            # 使用 PostGIS 查詢範圍內的戶數
-            query = text("""       
-                SELECT count(*) as households
-                FROM households
-                WHERE ST_DWithin(
-                    geography(ST_SetSRID(ST_Point(:longitude, :latitude), 4326)),
-                    geography(geometry),
-                    :radius
-                );
-            """)
-            result = await session.execute(query, {
-                "longitude": request.longitude,
-                "latitude": request.latitude,
-                "radius": request.radius
-            })
-            data = result.fetchone()
-
-            if data:
-                return HouseholdsResponse(households=data.households or 0)
-            else:
-                raise HTTPException(status_code=404, detail="No data found within the specified radius")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    try:
+        data = await fetch_row(HOUSEHOLDS_POINT_QUERY, request)
+
+        if data:
+            return json_response(households_response(data, request))
+        else:
+            raise HTTPException(status_code=404, detail="No data found within the specified radius")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 # 計算單點半徑範圍內人口數
 @app.post("/population/point", response_model=PopulationResponse)
 async def get_population_within_radius(request: PointRequest):
-    async with SessionLocal() as session:
-        try:
-            # 使用 PostGIS 查詢範圍內的人口數
-            query = text("""
-                WITH 
-                target_point AS (
-                    SELECT ST_SetSRID(ST_MakePoint(:longitude, :latitude), 4326) AS geom
-                ),
-                buffered_area AS (
-                    SELECT ST_Buffer(ST_Transform(geom, 3857), :radius) AS geom
-                    FROM target_point
-                )
-                SELECT sum(population.p_cnt) as population
-                FROM population
-                JOIN buffered_area ON ST_Intersects(ST_Transform(population.geometry, 3857), buffered_area.geom)
-                WHERE (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), buffered_area.geom)) / ST_Area(ST_Transform(population.geometry, 3857))) >= :overlap_ratio;
-            """)
-            result = await session.execute(query, {
-                "longitude": request.longitude,
-                "latitude": request.latitude,
-                "radius": request.radius,
-                "overlap_ratio": request.overlap_ratio,
-            })
-            data = result.fetchone()
-
-            if data:
-                return PopulationResponse(population=data.population or 0)
-            else:
-                raise HTTPException(status_code=404, detail="No data found within the specified radius")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    try:
+        data = await fetch_row(POPULATION_POINT_QUERY, request)
+
+        if data:
+            return json_response(population_response(data, request))
+        else:
+            raise HTTPException(status_code=404, detail="No data found within the specified radius")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 # 計算單點半徑範圍內面積
 @app.post("/area/point", response_model=AreaResponse)
-async def get_area_within_radius(request: PointRequest):
-    async with SessionLocal() as session:
-        try:
-            # 使用 PostGIS 查詢範圍內的戶數
-            query = text("""       
-                SELECT ST_Area(
-                    ST_Buffer(
-                        ST_SetSRID(ST_Point(:longitude, :latitude), 4326)::geography, 
-                        :radius
-                    )
-                ) AS area;
-            """)
-            result = await session.execute(query, {
-                "longitude": request.longitude,
-                "latitude": request.latitude,
-                "radius": request.radius
-            })
-            data = result.fetchone()
-
-            if data:
-                return AreaResponse(area=data.area or 0)
-            else:
-                raise HTTPException(status_code=404, detail="No data found within the specified radius")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+async def get_area_within_radius(request: AreaPointRequest):
+    try:
+        # 於程式內以測地線計算 不需查詢資料庫
+        area = geodesic_buffer_area(request.longitude, request.latitude, request.radius)
+        return json_response({"area": area})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
         
 
 # 計算多點面積範圍內家戶數
 @app.post("/households/polygon", response_model=HouseholdsResponse)
 async def get_households_within_polygon(request: PolygonRequest):
-    async with SessionLocal() as session:
-        try:
-            # 使用 PostGIS 查詢範圍內的戶數
-            query = text("""
-                SELECT count(*) as households
-                FROM households
-                WHERE ST_Within(
-                    geometry, 
-                    ST_GeomFromText(:wkt_polygon, 4326));
-            """)
-            result = await session.execute(query, {
-                "wkt_polygon": request.wkt_polygon,
-            })
-            data = result.fetchone()
-
-            if data:
-                return HouseholdsResponse(households=data.households or 0)
-            else:
-                raise HTTPException(status_code=404, detail="No data found within the specified area")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    try:
+        data = await fetch_row(HOUSEHOLDS_POLYGON_QUERY, request)
+
+        if data:
+            return json_response(households_response(data, request))
+        else:
+            raise HTTPException(status_code=404, detail="No data found within the specified area")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 # 計算多點面積範圍內人口數
 @app.post("/population/polygon", response_model=PopulationResponse)
 async def get_households_within_polygon(request: PolygonRequest):
-    async with SessionLocal() as session:
-        try:
-            # 使用 PostGIS 查詢範圍內的人口數
-            query = text("""
-                WITH 
-                input_polygon AS (
-                    SELECT ST_SetSRID(ST_GeomFromText(:wkt_polygon), 4326) AS geom
-                )
-                SELECT sum(population.p_cnt) as population
-                FROM population
-                JOIN input_polygon ON ST_Intersects(ST_Transform(population.geometry, 3857), ST_Transform(input_polygon.geom, 3857))
-                WHERE (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), ST_Transform(input_polygon.geom, 3857))) / ST_Area(ST_Transform(population.geometry, 3857))) >= :overlap_ratio;
-            """)
-            result = await session.execute(query, {
-                "wkt_polygon": request.wkt_polygon,
-                "overlap_ratio": request.overlap_ratio,
-            })
-            data = result.fetchone()
-
-            if data:
-                return PopulationResponse(population=data.population or 0)
-            else:
-                raise HTTPException(status_code=404, detail="No data found within the specified area")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    try:
+        data = await fetch_row(POPULATION_POLYGON_QUERY, request)
+
+        if data:
+            return json_response(population_response(data, request))
+        else:
+            raise HTTPException(status_code=404, detail="No data found within the specified area")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# 計算多邊形變更前後的家戶數變化量
+# 只查詢落在前後範圍對稱差內的門牌 計算量與變更範圍大小成正比 而非整個範圍
+@app.post("/households/polygon/delta", response_model=HouseholdsDeltaResponse)
+async def get_households_delta_within_polygon(request: PolygonDeltaRequest):
+    try:
+        data = await fetch_row(HOUSEHOLDS_POLYGON_DELTA_QUERY, request)
+
+        if data:
+            check_snapshots(data, request)
+            return json_response({"households_delta": data["households_delta"] or 0, "snapshot": data["snapshot_date"]})
+        else:
+            raise HTTPException(status_code=404, detail="No data found within the specified area")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# 計算多邊形變更前後的人口數變化量
+# 與對稱差不相交的最小統計區 其重疊比率在變更前後相同 只需重新判斷與對稱差相交的統計區
+@app.post("/population/polygon/delta", response_model=PopulationDeltaResponse)
+async def get_population_delta_within_polygon(request: PolygonDeltaRequest):
+    try:
+        data = await fetch_row(POPULATION_POLYGON_DELTA_QUERY, request)
+
+        if data:
+            check_snapshots(data, request)
+            return json_response({"population_delta": int(data["population_delta"] or 0), "snapshot": data["snapshot_date"]})
+        else:
+            raise HTTPException(status_code=404, detail="No data found within the specified area")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 # 計算多點面積範圍內面積
 @app.post("/area/polygon", response_model=AreaResponse)
-async def get_area_within_polygon(request: PolygonRequest):
-    async with SessionLocal() as session:
-        try:
-            # 使用 PostGIS 查詢範圍內的戶數
-            query = text("""
-                SELECT ST_Area(
-                    ST_Transform(
-                        ST_GeomFromText(
-                            :wkt_polygon, 
-                            4326
-                        ), 
-                        32651
-                    )
-                ) AS area;
-            """)
-            result = await session.execute(query, {
-                "wkt_polygon": request.wkt_polygon,
-            })
-            data = result.fetchone()
-
-            if data:
-                return AreaResponse(area=data.area or 0)
-            else:
-                raise HTTPException(status_code=404, detail="No data found within the specified area")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+async def get_area_within_polygon(request: AreaPolygonRequest):
+    try:
+        # 於程式內以測地線計算 不需查詢資料庫
+        area = geodesic_area(request.wkt_polygon)
+        return json_response({"area": area})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
         
 
+# 以密度網格估算多邊形範圍內的家戶數與人口數(不查詢資料庫 供精確結果回傳前的即時參考)
+# 網格運算為CPU密集工作 以一般函式定義 由FastAPI在執行緒池中執行 不阻塞事件迴圈
+@app.post("/density/estimate", response_model=DensityEstimateResponse)
+def get_density_estimate_within_polygon(request: DensityEstimateRequest):
+    try:
+        return json_response(density_estimate(request.wkt_polygon))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# 取得密度熱度圖圖磚 layer為households(門牌數)或population(人口數)
+@app.get("/density/tiles/{layer}/{z}/{x}/{y}.png")
+def get_density_tile(layer: str, z: int, x: int, y: int):
+    if layer not in DENSITY_LAYERS:
+        raise HTTPException(status_code=404, detail="Density layer not found")
+    try:
+        return Response(content=render_density_tile(layer, z, x, y), media_type="image/png")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# 預先載入延遲載入的套件與共用物件
+# 多worker部署時於master執行 fork後的worker以copy-on-write共用 不需各自載入
+# 以下匯入只為了預先載入模組(並非未使用) 請勿移除
+def preload():
+    import numpy  # noqa: F401
+    import shapely.wkt  # noqa: F401
+    import shapely.geometry.polygon  # noqa: F401
+    get_geod()
+
+    # 密度網格可能尚未由匯入程式產生或正在更新 此時於第一次使用時才讀取
+    try:
+        _, meta, _, _ = get_density_grid()
+        get_grid_transformer(meta["crs"])
+    except (OSError, RuntimeError):
+        pass
+
+
+if os.getenv("APP_PRELOAD"):
+    preload()
+
+
 # 主程式
 if __name__ == "__main__":
     uvicorn.run("app:app", host="127.0.0.1", port=8000, reload=True)
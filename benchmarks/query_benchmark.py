@@ -0,0 +1,103 @@
+# API查詢層效能測試
+# 比較原本每個請求建立SQLAlchemy AsyncSession與text()查詢、以Pydantic模型回傳的作法
+# 與目前asyncpg連線池、已準備查詢語句與orjson編碼的作法 每個請求的處理時間
+# 需先啟動PostGIS資料庫並匯入資料 使用方式: python benchmarks/query_benchmark.py [請求次數]
+import asyncio
+import json
+import os
+import re
+import statistics
+import sys
+import time
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
+import app as api  # noqa: E402
+
+WARMUP = 50
+
+# 只回傳常數的查詢 用來量測不含PostGIS運算的純請求開銷
+SELECT_1_QUERY = api.prepare_query("""
+    SELECT CAST(:radius AS float8) AS households, NULL::bigint AS compare_households,
+    CURRENT_DATE AS snapshot_date, NULL::date AS compare_snapshot_date
+""")
+
+
+# 將位置參數($1)的查詢語句還原為具名參數(:name) 供原本的SQLAlchemy作法使用
+def ToNamedQuery(query):
+    sql, params = query
+    return re.sub(r'\$(\d+)', lambda match: f':{params[int(match.group(1)) - 1]}', sql)
+
+
+# 原本的作法: 每個請求建立Session與text()查詢 回傳前經Pydantic模型驗證與JSON編碼
+async def RunSessionRequest(SessionLocal, namedSql, request):
+    async with SessionLocal() as session:
+        result = await session.execute(text(namedSql), request.model_dump())
+        data = result.fetchone()
+        response = api.HouseholdsResponse(households=data.households or 0, snapshot=data.snapshot_date)
+        return json.dumps(jsonable_encoder(response)).encode()
+
+
+# 目前的作法: 自連線池取得連線執行已準備的查詢語句 以orjson編碼
+async def RunPreparedRequest(query, request):
+    data = await api.fetch_row(query, request)
+    return orjson.dumps(api.households_response(data, request))
+
+
+# 重複執行請求並統計每次請求的處理時間(微秒)
+async def Measure(runRequest, times):
+
+    for _ in range(WARMUP):
+        await runRequest()
+
+    elapsed = []
+    for _ in range(times):
+        start = time.perf_counter()
+        await runRequest()
+        elapsed.append((time.perf_counter() - start) * 1e6)
+
+    elapsed.sort()
+    return {
+        'mean': statistics.fmean(elapsed),
+        'p50': elapsed[len(elapsed) // 2],
+        'p99': elapsed[int(len(elapsed) * 0.99) - 1],
+    }
+
+
+async def RunBenchmark(times):
+
+    engine = create_async_engine(f"postgresql+asyncpg://{api.user}:{api.password}@{api.host}:{api.port}/{api.database}")
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=AsyncSession)
+
+    request = api.PointRequest(longitude=120.1854, latitude=22.9921, radius=500)
+    queries = {
+        'select 1': SELECT_1_QUERY,
+        'households/point': api.HOUSEHOLDS_POINT_QUERY,
+    }
+
+    print(f"{'query':<20}{'path':<12}{'mean(us)':>12}{'p50(us)':>12}{'p99(us)':>12}")
+
+    async with api.lifespan(api.app):
+        for name, query in queries.items():
+
+            namedSql = ToNamedQuery(query)
+            results = {
+                'session': await Measure(lambda: RunSessionRequest(SessionLocal, namedSql, request), times),
+                'prepared': await Measure(lambda: RunPreparedRequest(query, request), times),
+            }
+
+            for path, result in results.items():
+                print(f"{name:<20}{path:<12}{result['mean']:>12.1f}{result['p50']:>12.1f}{result['p99']:>12.1f}")
+            print(f"{name:<20}{'saved':<12}{results['session']['mean'] - results['prepared']['mean']:>12.1f}")
+
+    await engine.dispose()
+
+
+# 主程式
+if __name__ == '__main__':
+    asyncio.run(RunBenchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000))
@@ -0,0 +1,109 @@
+# worker啟動效能測試
+# 比較延遲載入(lazy)與預先載入(preload)兩種模式下 載入程式的時間與fork後worker的記憶體用量
+# 需於Linux環境執行(讀取/proc記憶體資訊) 並已安裝requirements.txt內的套件
+# 使用方式: python benchmarks/startup_benchmark.py
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APPS = ['web', 'api']
+MODES = ['lazy', 'preload']
+
+
+# 讀取目前程序的記憶體資訊(KB)
+def ReadMemory():
+
+    memory = {}
+
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                memory['rss'] = int(line.split()[1])
+
+    # 只屬於此程序(未與其他程序共用)的記憶體
+    with open('/proc/self/smaps_rollup') as f:
+        memory['private'] = sum(
+            int(line.split()[1]) for line in f
+            if line.startswith(('Private_Clean:', 'Private_Dirty:'))
+        )
+
+    return memory
+
+
+# 於獨立的Python程序中載入程式 並fork出一個worker量測
+def RunChild(appName, mode):
+
+    # 明確設定模式 不沿用外部環境(例如docker-compose)的APP_PRELOAD設定
+    if mode == 'preload':
+        os.environ['APP_PRELOAD'] = '1'
+    else:
+        os.environ.pop('APP_PRELOAD', None)
+
+    sys.path.insert(0, os.path.join(ROOT, appName))
+
+    # master載入程式
+    start = time.perf_counter()
+    import app
+    importSeconds = time.perf_counter() - start
+    masterMemory = ReadMemory()
+
+    # fork出worker 並載入處理請求時才需要的套件(模擬第一次匯出或計算請求)
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(reader)
+        start = time.perf_counter()
+        app.preload()
+        firstRequestSeconds = time.perf_counter() - start
+        workerMemory = ReadMemory()
+        os.write(writer, json.dumps({
+            'first_request_seconds': firstRequestSeconds,
+            'worker_rss_kb': workerMemory['rss'],
+            'worker_private_kb': workerMemory['private'],
+        }).encode())
+        os._exit(0)
+
+    os.close(writer)
+    with os.fdopen(reader) as f:
+        worker = json.loads(f.read())
+    os.waitpid(pid, 0)
+
+    print(json.dumps({
+        'import_seconds': importSeconds,
+        'master_rss_kb': masterMemory['rss'],
+        **worker,
+    }))
+
+
+# 依序測試各程式與模式 並輸出結果表格
+def RunBenchmark():
+
+    print(f"{'app':<6}{'mode':<9}{'import(s)':>10}{'1st req(s)':>12}{'master RSS(MB)':>16}{'worker RSS(MB)':>16}{'worker private(MB)':>20}")
+
+    for appName in APPS:
+        for mode in MODES:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child', appName, mode],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(
+                f"{appName:<6}{mode:<9}"
+                f"{result['import_seconds']:>10.3f}"
+                f"{result['first_request_seconds']:>12.3f}"
+                f"{result['master_rss_kb'] / 1024:>16.1f}"
+                f"{result['worker_rss_kb'] / 1024:>16.1f}"
+                f"{result['worker_private_kb'] / 1024:>20.1f}"
+            )
+
+
+# 主程式
+if __name__ == '__main__':
+
+    if len(sys.argv) == 4 and sys.argv[1] == '--child':
+        RunChild(sys.argv[2], sys.argv[3])
+    else:
+        RunBenchmark()
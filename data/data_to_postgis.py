@@ -1,7 +1,10 @@
 # 將外部公開資料傳入PostGis
 import pandas as pd
+import numpy as np
+import shapely
+import json
 from pyproj import Transformer
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 import geopandas as gpd
 from shapely.geometry import Point
 import os
@@ -23,11 +26,77 @@ def CreateSQLEngine():
     return engine
 
 
+# 以快照日期分區匯入資料函數
+# 每次發布的資料(人口為每月、門牌為每年)匯入為分區表的一個分區，不再覆蓋舊資料
+def ImportSnapshotPartition(engine, gdf, tableName, snapshotDate):
+
+    snapshotDate = pd.Timestamp(snapshotDate).date()
+    stagingName = f'{tableName}_staging'
+    partitionName = f'{tableName}_{snapshotDate:%Y%m%d}'
+
+    # 加入快照日期欄位後先匯入暫存表
+    gdf = gdf.copy()
+    gdf['snapshot_date'] = snapshotDate
+    gdf.to_postgis(stagingName, con=engine, if_exists='replace')
+
+    columns = ', '.join(f'"{col}"' for col in gdf.columns)
+
+    with engine.begin() as conn:
+
+        # 快照清單 供API查詢指定日期所對應的快照
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS snapshots (
+                table_name text NOT NULL,
+                snapshot_date date NOT NULL,
+                PRIMARY KEY (table_name, snapshot_date)
+            );
+        """))
+
+        # 舊版匯入程式建立的一般資料表無法掛上分區 需先移除
+        relkind = conn.execute(
+            text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"),
+            {'name': tableName},
+        ).scalar()
+        if relkind == 'r':
+            conn.execute(text(f'DROP TABLE {tableName}'))
+
+        # 建立以快照日期分區的主表
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {tableName} (LIKE {stagingName})
+            PARTITION BY LIST (snapshot_date);
+        """))
+        conn.execute(text(f"""
+            CREATE INDEX IF NOT EXISTS idx_{tableName}_geometry
+            ON {tableName} USING GIST (geometry);
+        """))
+
+        # 重新匯入同一快照時以新資料取代該分區
+        conn.execute(text(f'DROP TABLE IF EXISTS {partitionName}'))
+
+        conn.execute(text(f"""
+            CREATE TABLE {partitionName} PARTITION OF {tableName}
+            FOR VALUES IN ('{snapshotDate}');
+        """))
+
+        # 由暫存表寫入分區
+        conn.execute(text(f'INSERT INTO {tableName} ({columns}) SELECT {columns} FROM {stagingName}'))
+        conn.execute(text(f'DROP TABLE {stagingName}'))
+
+        # 登記快照
+        conn.execute(text("""
+            INSERT INTO snapshots (table_name, snapshot_date)
+            VALUES (:table_name, :snapshot_date)
+            ON CONFLICT DO NOTHING;
+        """), {'table_name': tableName, 'snapshot_date': snapshotDate})
+
+        conn.execute(text(f'ANALYZE {partitionName}'))
+
+
 # 整理臺南市門牌座標資料函數
-def ImportHouseholdsData(engine):
+def ImportHouseholdsData(engine, fileName='112年臺南市門牌坐標資料.csv', snapshotDate='2023-01-01'):
 
     # 讀取門牌座標資料
-    householdsData = pd.read_csv('112年臺南市門牌坐標資料.csv')
+    householdsData = pd.read_csv(fileName)
 
     # 建立經緯度轉換器
     transformer = Transformer.from_crs("EPSG:3826", "EPSG:4326", always_xy=True)
@@ -54,26 +123,114 @@ def ImportHouseholdsData(engine):
     # 設定座標系統
     householdsData.crs = 'EPSG:4326'
 
-    # 匯入資料至資料庫
-    householdsData.to_postgis('households', con=engine, if_exists='replace')
+    # 匯入資料至資料庫(依快照日期分區)
+    ImportSnapshotPartition(engine, householdsData, 'households', snapshotDate)
 
     return householdsData
 
 
 # 匯入臺南市人口統計資料函數
-def ImportPopulationData(engine):
+def ImportPopulationData(engine, fileName='112年12月臺南市統計區人口統計_最小統計區_WGS84.geojson', snapshotDate='2023-12-01'):
 
     # 讀取Geojson檔案
-    fileName = '112年12月臺南市統計區人口統計_最小統計區_WGS84.geojson'
     populationData = gpd.read_file(fileName)
     populationData.columns = populationData.columns.str.lower()
 
-    # 匯入資料至資料庫
-    populationData.to_postgis('population', con=engine, if_exists='replace')
+    # 匯入資料至資料庫(依快照日期分區)
+    ImportSnapshotPartition(engine, populationData, 'population', snapshotDate)
     
     return populationData
 
 
+# 先寫入暫存檔再以os.replace取代原檔函數
+# API以記憶體映射讀取的舊檔不會被截斷 也不會讀到寫入中的檔案
+def WriteFileAtomically(path, writeFunction):
+    tempPath = f'{path}.tmp'
+    with open(tempPath, 'wb') as f:
+        writeFunction(f)
+    os.replace(tempPath, path)
+
+
+# 建立門牌與人口密度網格函數
+# 以公尺為單位的TWD97座標系切分固定大小網格 門牌依所在網格計數 人口依最小統計區與網格的重疊面積比例分配
+# 另計算累加面積表(summed-area table) 任意網格矩形範圍的總和只需查詢4個值
+def ImportDensityGrid(engine, householdsData, populationData, outputPath=os.getenv("GRID_PATH", "grid"), cellSize=100):
+
+    crs = 'EPSG:3826'
+    householdsData = householdsData.to_crs(crs)
+    populationData = populationData.to_crs(crs)
+
+    # 以人口統計區範圍(臺南市)作為網格範圍
+    minX, minY, maxX, maxY = populationData.total_bounds
+    x0 = np.floor(minX / cellSize) * cellSize
+    y0 = np.floor(minY / cellSize) * cellSize
+    cols = int(np.ceil((maxX - x0) / cellSize))
+    rows = int(np.ceil((maxY - y0) / cellSize))
+
+    # 網格第0層為門牌數 第1層為人口數 列(row)由南往北、欄(col)由西往東
+    grid = np.zeros((2, rows, cols))
+
+    # 門牌數: 依座標計算所在網格後累加
+    col = np.floor((householdsData.geometry.x.to_numpy() - x0) / cellSize).astype(int)
+    row = np.floor((householdsData.geometry.y.to_numpy() - y0) / cellSize).astype(int)
+    inside = (col >= 0) & (col < cols) & (row >= 0) & (row < rows)
+    np.add.at(grid[0], (row[inside], col[inside]), 1)
+
+    # 人口數: 依統計區與其範圍內各網格的重疊面積比例分配
+    for geometry, count in zip(populationData.geometry, populationData['p_cnt']):
+
+        if geometry is None or geometry.is_empty or not count:
+            continue
+
+        bMinX, bMinY, bMaxX, bMaxY = geometry.bounds
+        colRange = np.arange(int((bMinX - x0) // cellSize), min(int((bMaxX - x0) // cellSize) + 1, cols))
+        rowRange = np.arange(int((bMinY - y0) // cellSize), min(int((bMaxY - y0) // cellSize) + 1, rows))
+        colIndex, rowIndex = np.meshgrid(colRange, rowRange)
+        colIndex, rowIndex = colIndex.ravel(), rowIndex.ravel()
+
+        cells = shapely.box(
+            x0 + colIndex * cellSize, y0 + rowIndex * cellSize,
+            x0 + (colIndex + 1) * cellSize, y0 + (rowIndex + 1) * cellSize,
+        )
+        overlap = shapely.area(shapely.intersection(cells, geometry))
+        np.add.at(grid[1], (rowIndex, colIndex), count * overlap / geometry.area)
+
+    # 累加面積表: sat[:, r, c] 為第0至r-1列、第0至c-1欄網格的總和
+    sat = np.zeros((2, rows + 1, cols + 1))
+    sat[:, 1:, 1:] = grid.cumsum(axis=1).cumsum(axis=2)
+
+    # 儲存為NumPy檔案 供API以記憶體映射(memory-map)方式讀取
+    # 中繼資料最後寫入 API依此判斷檔案是否已全部更新完成
+    os.makedirs(outputPath, exist_ok=True)
+    WriteFileAtomically(os.path.join(outputPath, 'density_grid.npy'), lambda f: np.save(f, grid.astype(np.float32)))
+    WriteFileAtomically(os.path.join(outputPath, 'density_sat.npy'), lambda f: np.save(f, sat))
+    WriteFileAtomically(os.path.join(outputPath, 'density_grid.json'), lambda f: f.write(json.dumps({
+        'crs': crs,
+        'x0': float(x0),
+        'y0': float(y0),
+        'cell_size': cellSize,
+        'rows': rows,
+        'cols': cols,
+        'max_households': float(grid[0].max()),
+        'max_population': float(grid[1].max()),
+    }).encode()))
+
+    # 匯入有資料的網格至資料庫
+    rowIndex, colIndex = np.nonzero(grid.sum(axis=0))
+    gridData = gpd.GeoDataFrame({
+        'row': rowIndex,
+        'col': colIndex,
+        'households': grid[0, rowIndex, colIndex],
+        'population': grid[1, rowIndex, colIndex],
+    }, geometry=shapely.box(
+        x0 + colIndex * cellSize, y0 + rowIndex * cellSize,
+        x0 + (colIndex + 1) * cellSize, y0 + (rowIndex + 1) * cellSize,
+    ), crs=crs).to_crs('EPSG:4326')
+    gridData.to_postgis('density_grid', con=engine, if_exists='replace')
+
+    return grid
+
+
 # 自PostGIS資料庫讀取資料
 def GetPostGISData(engine, tableName):
     gdf = gpd.read_postgis(tableName, con=engine, geom_col='geometry')
@@ -87,10 +244,13 @@ if __name__ == '__main__':
     engine = CreateSQLEngine()
 
     # 整理臺南市門牌座標資料
-    ImportHouseholdsData(engine)
+    householdsData = ImportHouseholdsData(engine)
 
     # 整理臺南市人口統計資料
-    ImportPopulationData(engine)
+    populationData = ImportPopulationData(engine)
+
+    # 建立門牌與人口密度網格
+    ImportDensityGrid(engine, householdsData, populationData)
 
     # 自PostGIS資料庫讀取臺南市門牌座標資料
     householdsData = GetPostGISData(engine, 'households')
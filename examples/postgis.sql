@@ -6,6 +6,14 @@ SELECT * FROM public.households;
 /*查詢臺南是最小行政區人口資料*/
 SELECT * FROM public.population;
 
+/*查詢已匯入的資料快照*/
+SELECT * FROM public.snapshots ORDER BY table_name, snapshot_date;
+
+/*查詢指定快照的門牌數(只會掃描該快照的分區)*/
+SELECT count(*) as householdNums
+FROM households
+WHERE snapshot_date = '2023-01-01';
+
 /*查詢指定點半徑範圍內門牌數*/
 SELECT count(*) as householdNums
 FROM households
@@ -13,14 +21,16 @@ WHERE ST_DWithin(
 	geography(ST_SetSRID(ST_Point(120.1854, 22.9921), 4326)),
 	geography(geometry),
 	200 --半徑範圍(公尺)
-);
+)
+AND snapshot_date = (SELECT max(snapshot_date) FROM snapshots WHERE table_name = 'households');  -- 只查詢最新一期快照 避免重複計算各期資料
 
 /*查詢指定多邊形範圍內的門牌資料*/
 SELECT *
 FROM households
 WHERE ST_Within(
 	geometry, 
-	ST_GeomFromText('POLYGON((120.1828 22.9961, 120.1811 22.9869, 120.1906 22.9926, 120.1828 22.9961))', 4326));
+	ST_GeomFromText('POLYGON((120.1828 22.9961, 120.1811 22.9869, 120.1906 22.9926, 120.1828 22.9961))', 4326))
+AND snapshot_date = (SELECT max(snapshot_date) FROM snapshots WHERE table_name = 'households');  -- 只查詢最新一期快照 避免重複計算各期資料
 
 /*查詢指定點半徑範圍內的最小行政區資料*/
 WITH 
@@ -38,7 +48,8 @@ SELECT
     (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), buffered_area.geom)) / ST_Area(ST_Transform(population.geometry, 3857))) AS overlap_ratio  -- 計算重疊比率
 FROM population
 JOIN buffered_area ON ST_Intersects(ST_Transform(population.geometry, 3857), buffered_area.geom)
-WHERE (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), buffered_area.geom)) / ST_Area(ST_Transform(population.geometry, 3857))) >= 0.8;  -- 0.8為重疊比率門檻 超過此門檻才會被選入
+WHERE (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), buffered_area.geom)) / ST_Area(ST_Transform(population.geometry, 3857))) >= 0.8  -- 0.8為重疊比率門檻 超過此門檻才會被選入
+AND population.snapshot_date = (SELECT max(snapshot_date) FROM snapshots WHERE table_name = 'population');  -- 只查詢最新一期快照 避免重複計算各期資料
 
 /*查詢指定點半徑範圍內的人口數*/
 WITH 
@@ -52,7 +63,8 @@ buffered_area AS (
 SELECT sum(population.p_cnt) as population
 FROM population
 JOIN buffered_area ON ST_Intersects(ST_Transform(population.geometry, 3857), buffered_area.geom)
-WHERE (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), buffered_area.geom)) / ST_Area(ST_Transform(population.geometry, 3857))) >= 0.8;  -- 0.8為重疊比率門檻 超過此門檻才會被選入
+WHERE (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), buffered_area.geom)) / ST_Area(ST_Transform(population.geometry, 3857))) >= 0.8  -- 0.8為重疊比率門檻 超過此門檻才會被選入
+AND population.snapshot_date = (SELECT max(snapshot_date) FROM snapshots WHERE table_name = 'population');  -- 只查詢最新一期快照 避免重複計算各期資料
 
 /*查詢指定多邊形範圍內的人口數*/
 WITH 
@@ -62,7 +74,8 @@ input_polygon AS (
 SELECT sum(population.p_cnt) as population
 FROM population
 JOIN input_polygon ON ST_Intersects(ST_Transform(population.geometry, 3857), ST_Transform(input_polygon.geom, 3857))
-WHERE (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), ST_Transform(input_polygon.geom, 3857))) / ST_Area(ST_Transform(population.geometry, 3857))) >= 0.8;
+WHERE (ST_Area(ST_Intersection(ST_Transform(population.geometry, 3857), ST_Transform(input_polygon.geom, 3857))) / ST_Area(ST_Transform(population.geometry, 3857))) >= 0.8
+AND population.snapshot_date = (SELECT max(snapshot_date) FROM snapshots WHERE table_name = 'population');  -- 只查詢最新一期快照 避免重複計算各期資料
 
 /*查詢指定點半徑範圍內的面積*/
 SELECT ST_Area(
@@ -74,11 +87,8 @@ SELECT ST_Area(
 
 /*查詢指定多邊形範圍內的面積*/
 SELECT ST_Area(
-    ST_Transform(
-        ST_GeomFromText(
-            'POLYGON((120.1828 22.9961, 120.1811 22.9869, 120.1906 22.9926, 120.1828 22.9961))', 
-            4326
-        ), 
-        32651
-    )
+    ST_GeomFromText(
+        'POLYGON((120.1828 22.9961, 120.1811 22.9869, 120.1906 22.9926, 120.1828 22.9961))', 
+        4326
+    )::geography  -- 以geography於WGS84橢球面上計算面積(平方公尺) 與API的計算方式一致
 ) AS area;
@@ -3,10 +3,6 @@ import dash_bootstrap_components as dbc
 from dash import Input, Output, State, ALL, dcc, html, dash_table
 import dash_leaflet as dl
 from dash_extensions.javascript import assign
-import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Polygon
-from shapely import wkt
 import requests
 import os
 
@@ -14,6 +10,39 @@ import os
 api_server = os.getenv("API_HOST", "127.0.0.1")
 api_port = 8000
 
+# 瀏覽器連線API的網址(地圖圖磚由瀏覽器直接向API取得)
+api_public_url = os.getenv("API_PUBLIC_URL", "http://127.0.0.1:8000")
+
+# 人口數計算時與最小統計區的重疊範圍比率門檻
+overlap_ratio = 0.5
+
+
+# 呼叫API 成功時回傳JSON內容 失敗時回傳None
+def post_api(path, data):
+    response = requests.post(f'http://{api_server}:{api_port}{path}', json=data)
+    if response.status_code == 200:
+        return response.json()
+    return None
+
+
+# 取出使用者標記的第一個多邊形外圍邊界 轉為WKT格式 沒有資料時回傳None
+def geojson_to_wkt(x):
+    from shapely.geometry import Polygon
+
+    # 取出使用者標記的經緯度範圍，如果沒有資料則設為空列表
+    coordinates = [elem['geometry']['coordinates'] for elem in x.get('features', [])] if x else []
+
+    if coordinates:
+
+        # 只取第一個多邊形的外圍邊界
+        outer_boundary = coordinates[0][0] if isinstance(coordinates[0], list) else []
+
+        # 確保外圍邊界是正確格式並創建多邊形
+        if outer_boundary and isinstance(outer_boundary[0], list):
+            return Polygon(outer_boundary).wkt
+
+    return None
+
 
 app = dash.Dash(
     title='地圖範圍標記資訊工具',
@@ -76,6 +105,19 @@ app.layout = dbc.Container([
                 zoom=11,
                 children=[
                     dl.TileLayer(),  # 基礎地圖
+                    # 密度熱度圖圖層(由API依密度網格產生圖磚)
+                    dl.LayersControl([
+                        dl.Overlay(
+                            dl.TileLayer(url=f"{api_public_url}/density/tiles/population/{{z}}/{{x}}/{{y}}.png", opacity=0.6),
+                            name="人口密度",
+                            checked=False,
+                        ),
+                        dl.Overlay(
+                            dl.TileLayer(url=f"{api_public_url}/density/tiles/households/{{z}}/{{x}}/{{y}}.png", opacity=0.6),
+                            name="門牌密度",
+                            checked=False,
+                        ),
+                    ]),
                     dl.FeatureGroup([
                         # 開啟地圖編輯控制
                         dl.EditControl(
@@ -128,6 +170,13 @@ app.layout = dbc.Container([
                 ]),
             ], className="mb-3"),
 
+            # 密度網格估算結果(精確結果計算完成前的參考值)
+            dbc.Row([
+                dbc.Col([
+                    html.Small(id="density-estimate", className="text-muted"),
+                ]),
+            ], className="mb-3"),
+
             html.Div(id='custom-inputs'),
 
             dbc.Row([
@@ -160,7 +209,9 @@ app.layout = dbc.Container([
     html.Div(id="download-data-component"),
 
     # 暫存資料表
-    dcc.Store(id='store-data', data=pd.DataFrame().to_dict('records')),
+    dcc.Store(id='store-data', data=[]),
+    # 暫存目前標記範圍與計算結果 編輯範圍時只需計算變更部分
+    dcc.Store(id='polygon-state'),
     # 下載CSV格式檔案資料
     dcc.Download(id="download-csv-data"),
     # 下載GeoJson格式檔案資料
@@ -239,62 +290,144 @@ def generate_inputs(field_name, field_type):
         Output("data-polygon", "value"),
         Output('data-households', 'value'),
         Output('data-population', 'value'),
-        Output('data-area', 'value'),
-        Input("edit-control", "geojson")
+        Output('polygon-state', 'data'),
+        Input("edit-control", "geojson"),
+        State('polygon-state', 'data'),
 )
-def get_polygon(x):
+def get_polygon(x, state):
 
-    # 取出使用者標記的經緯度範圍，如果沒有資料則設為空列表
-    coordinates = [elem['geometry']['coordinates'] for elem in x.get('features', [])] if x else []
+    wkt = geojson_to_wkt(x)
 
-    if coordinates:
+    households = None
+    population = None
+    households_snapshot = None
+    population_snapshot = None
+    previous = state or {}
 
-        # 只取第一個多邊形的外圍邊界
-        outer_boundary = coordinates[0][0] if isinstance(coordinates[0], list) else []
+    # 範圍未變更時沿用前次結果
+    if wkt and wkt == previous.get('wkt'):
+        households = previous.get('households')
+        population = previous.get('population')
+        households_snapshot = previous.get('households_snapshot')
+        population_snapshot = previous.get('population_snapshot')
 
-        # 確保外圍邊界是正確格式並創建多邊形
-        if outer_boundary and isinstance(outer_boundary[0], list):
-            polygon = Polygon(outer_boundary)
-            wkt = polygon.wkt
-        else:
-            wkt = None
-    else:
-        wkt = None
+    # 編輯既有範圍時 只計算前後範圍差異部分的變化量
+    # 指定前次結果所用的資料快照 編輯期間匯入新資料時仍以同一期資料累加
+    elif wkt and previous.get('wkt'):
 
-    households = None
-    population = None
-    area = None
-    if wkt:
+        data = {
+            'previous_wkt_polygon': previous['wkt'],
+            'wkt_polygon': wkt,
+            'overlap_ratio': overlap_ratio,
+        }
+
+        # 取得家戶數變化量
+        if previous.get('households') is not None and previous.get('households_snapshot'):
+            result = post_api('/households/polygon/delta', {**data, 'snapshot': previous['households_snapshot']})
+            if result and result['snapshot'] == previous['households_snapshot']:
+                households = previous['households'] + result['households_delta']
+                households_snapshot = previous['households_snapshot']
+
+        # 取得人口數變化量
+        if previous.get('population') is not None and previous.get('population_snapshot'):
+            result = post_api('/population/polygon/delta', {**data, 'snapshot': previous['population_snapshot']})
+            if result and result['snapshot'] == previous['population_snapshot']:
+                population = previous['population'] + result['population_delta']
+                population_snapshot = previous['population_snapshot']
+
+    # 新標記範圍或變化量計算失敗時 重新計算整個範圍
+    if wkt and households is None:
 
         # 取得使用者選取範圍內的家戶數
-        url = f'http://{api_server}:{api_port}/households/polygon'
-        data = {
+        result = post_api('/households/polygon', {
             'wkt_polygon': wkt
-        }
-        response = requests.post(url, json=data)
-        if response.status_code == 200:
-            households = response.json()['households']
+        })
+        if result:
+            households = result['households']
+            households_snapshot = result['snapshot']
+
+    if wkt and population is None:
 
         # 取得使用者選取範圍內的人口數
-        url = f'http://{api_server}:{api_port}/population/polygon'
-        data = {
-            'overlap_ratio': 0.5,
+        result = post_api('/population/polygon', {
+            'overlap_ratio': overlap_ratio,
             'wkt_polygon': wkt
+        })
+        if result:
+            population = result['population']
+            population_snapshot = result['snapshot']
+
+    state = {
+        'wkt': wkt,
+        'households': households,
+        'population': population,
+        'households_snapshot': households_snapshot,
+        'population_snapshot': population_snapshot,
+    } if wkt else None
+
+    return x, wkt, households, population, state
+
+
+# 以密度網格即時估算標記範圍內的門牌數與人口數
+# 與精確計算分開執行 不需等待資料庫查詢即可先顯示參考值
+@app.callback(
+    Output("density-estimate", "children"),
+    Input("edit-control", "geojson"),
+)
+def get_density_estimate(x):
+
+    wkt = geojson_to_wkt(x)
+    if not wkt:
+        return None
+
+    result = post_api('/density/estimate', {
+        'wkt_polygon': wkt
+    })
+    if not result:
+        return None
+
+    return f"密度網格估算: 約{round(result['households']):,}戶門牌、{round(result['population']):,}人"
+
+
+# 於瀏覽器端即時計算標記範圍面積(不需呼叫API)
+# 將緯度轉為WGS84橢球的等積緯度後以梯形公式計算 與API的測地線面積結果一致
+app.clientside_callback(
+    """
+    function(geojson) {
+
+        // 只取第一個多邊形的外圍邊界
+        const features = (geojson && geojson.features) || [];
+        const ring = features.length ? features[0].geometry.coordinates[0] : null;
+        if (!ring || ring.length < 4) {
+            return null;
         }
-        response = requests.post(url, json=data)
-        if response.status_code == 200:
-            population = response.json()['population']
 
-        # 取得使用者選取範圍的面積
-        url = f'http://{api_server}:{api_port}/area/polygon'
-        data = {
-            'wkt_polygon': wkt
+        // WGS84橢球參數
+        const a = 6378137.0;
+        const f = 1 / 298.257223563;
+        const e2 = f * (2 - f);
+        const e = Math.sqrt(e2);
+
+        // 等積緯度函數
+        const q = function(lat) {
+            const s = Math.sin(lat * Math.PI / 180);
+            return (1 - e2) * (s / (1 - e2 * s * s) - Math.log((1 - e * s) / (1 + e * s)) / (2 * e));
+        };
+
+        let area = 0.0;
+        for (let i = 0; i < ring.length - 1; i++) {
+            const p1 = ring[i];
+            const p2 = ring[i + 1];
+            area += (p2[0] - p1[0]) * Math.PI / 180 * (q(p1[1]) + q(p2[1]));
         }
-        response = requests.post(url, json=data)
-        if response.status_code == 200:
-            area = round(response.json()['area'], 2)
+        area = Math.abs(area) * a * a / 4;
 
-    return x, wkt, households, population, area
+        return Math.round(area * 100) / 100;
+    }
+    """,
+    Output('data-area', 'value'),
+    Input("edit-control", "geojson"),
+)
 
 
 # 使用者新增資料
@@ -315,6 +448,7 @@ def get_polygon(x):
     State('data-population', 'value'),
 )
 def insert_data(n_clicks, data, field_label, field_value, data_polygon, data_area, data_households, data_population):
+    import pandas as pd
 
     # 初始輸出值
     dataset_table = None
@@ -402,6 +536,8 @@ def insert_data(n_clicks, data, field_label, field_value, data_polygon, data_are
 def download_csv(n_clicks, datasetName, data):
     
     if n_clicks > 0:
+        import pandas as pd
+
         df = pd.DataFrame(data).to_csv(encoding='utf-8-sig', index=False)
         return dcc.send_bytes(df.encode(), f"{datasetName}.csv")
 
@@ -416,6 +552,10 @@ def download_csv(n_clicks, datasetName, data):
 def download_geojson(n_clicks, datasetName, data):
 
     if n_clicks > 0:
+        import pandas as pd
+        import geopandas as gpd
+        from shapely import wkt
+
         df = pd.DataFrame(data)
         # 使用 WKT (Well-Known Text) 將 polygon 字串轉換為 Shapely Geometry 物件
         df['polygon'] = df['polygon'].apply(wkt.loads)
@@ -425,6 +565,20 @@ def download_geojson(n_clicks, datasetName, data):
         return dcc.send_bytes(df.encode(), f"{datasetName}.geojson")
 
 
+# 預先載入延遲載入的套件
+# 以gunicorn --preload部署多個worker時於master執行 fork後的worker以copy-on-write共用 不需各自載入
+# 以下匯入只為了預先載入模組(並非未使用) 請勿移除
+def preload():
+    import pandas  # noqa: F401
+    import geopandas  # noqa: F401
+    import shapely.geometry  # noqa: F401
+    import shapely.wkt  # noqa: F401
+
+
+if os.getenv("APP_PRELOAD"):
+    preload()
+
+
 # 主程式
 if __name__ == "__main__":
     app.run_server(host='0.0.0.0', port=8888, debug=True)
\ No newline at end of file